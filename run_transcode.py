@@ -3,8 +3,46 @@ import sys
 import os
 import json
 import logging
+import logging.handlers
+import queue
+import atexit
 import shutil
+import shlex
 import re
+import math
+import functools
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_EXCEPTION
+
+try:
+    # orjson parses ffprobe output faster, but the standard library is enough
+    import orjson
+    parse_json = orjson.loads
+except ImportError:
+    parse_json = json.loads
+
+# NVIDIA consumer drivers cap the number of concurrent NVENC sessions
+NVENC_SESSION_LIMIT = 3
+
+# Concurrent transcodes per GPU when max_concurrent is not set
+DEFAULT_GPU_CONCURRENCY = 2
+
+# Roughly how many CPU threads one x264/x265 encode keeps busy
+CPU_THREADS_PER_ENCODE = 8
+
+# Serializes progress writes from concurrent transcodes
+stdout_lock = threading.Lock()
+
+PROGRESS_PATTERN = re.compile(r'Encoding: task \d+ of \d+, (\d+\.\d+) %.*?(\d+\.\d+) fps.*?ETA (\d+h\d+m\d+s)')
+
+# Minimum number of seconds between progress line updates
+PROGRESS_INTERVAL = 0.25
+
+# With several files in flight each update is its own line, so print them less often
+CONCURRENT_PROGRESS_INTERVAL = 10.0
+
+LOG_LEVELS = ('DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL')
 
 def setup_logging():
     log_dir = 'logs'
@@ -31,9 +69,15 @@ def setup_logging():
     console_format = logging.Formatter('%(message)s')
     console_handler.setFormatter(console_format)
 
-    # Add handlers to the logger
-    logger.addHandler(file_handler)
-    logger.addHandler(console_handler)
+    # Hand records to a background thread so slow log writes never stall
+    # the loop draining HandBrake's output
+    log_queue = queue.Queue(-1)
+    listener = logging.handlers.QueueListener(log_queue, file_handler, console_handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+
+    # Add the queue handler to the logger
+    logger.addHandler(logging.handlers.QueueHandler(log_queue))
 
     return logger
 
@@ -58,6 +102,11 @@ def load_config():
             config = json.loads(content)
             # Ensure video_codec is lowercase
             config['video_codec'] = config['video_codec'].lower()
+            # Ensure log_level is an uppercase level name logging understands
+            config['log_level'] = str(config.get('log_level', 'DEBUG')).upper()
+            if config['log_level'] not in LOG_LEVELS:
+                logger.error(f"Invalid log_level in config: {config['log_level']}. Expected one of {', '.join(LOG_LEVELS)}")
+                raise ValueError(f"Invalid log_level in config: {config['log_level']}")
             return config
         except json.JSONDecodeError as e:
             logger.error(f"Invalid JSON in config file: {e}")
@@ -65,69 +114,114 @@ def load_config():
             logger.error(content)
             raise
 
+@functools.lru_cache(maxsize=1)
 def check_handbrake_installed():
-    try:
-        subprocess.run(["HandBrakeCLI", "--version"], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-        return True
-    except FileNotFoundError:
-        return False
+    # A PATH lookup is enough; running HandBrakeCLI --version costs a full startup
+    return shutil.which("HandBrakeCLI") is not None
+
+FFPROBE_ARGS = [
+    "-v", "quiet",
+    "-print_format", "json",
+    # Only the fields print_video_comparison and verify_transcoding read
+    "-show_entries", "format=duration,bit_rate:stream=codec_type,codec_name,width,height",
+]
+
+# Raw ffprobe output gathered by prefetch_video_info, keyed like the probe cache
+prefetched_probes = {}
+
+def _probe_key(path):
+    # Key the cache on mtime and size so a rewritten file is probed again
+    st = os.stat(path)
+    return (path, st.st_mtime_ns, st.st_size)
 
 def get_video_info(file_path):
-    command = [
-        "ffprobe",
-        "-v", "quiet",
-        "-print_format", "json",
-        "-show_format",
-        "-show_streams",
-        file_path
-    ]
-    result = subprocess.run(command, capture_output=True, text=True)
-    return json.loads(result.stdout)
+    return _probe_video(*_probe_key(file_path))
+
+@functools.lru_cache(maxsize=512)
+def _probe_video(file_path, mtime_ns, size):
+    output = prefetched_probes.pop((file_path, mtime_ns, size), None)
+    if output is None:
+        output = _run_ffprobe(file_path).stdout
+    return parse_json(output)
+
+def _run_ffprobe(file_path):
+    command = ["ffprobe", *FFPROBE_ARGS, file_path]
+    return subprocess.run(command, capture_output=True)
+
+def prefetch_video_info(paths):
+    keys = [_probe_key(path) for path in paths]
+    # Probes mostly wait on ffprobe startup and disk, so use more threads than cores
+    max_workers = min(32, (os.cpu_count() or 1) * 4)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = list(executor.map(_run_ffprobe, paths))
+    for key, result in zip(keys, results):
+        # Failed probes are left for get_video_info to retry and report later
+        if result.returncode == 0:
+            prefetched_probes[key] = result.stdout
+
+SIZE_UNITS = ('B', 'KB', 'MB', 'GB', 'TB', 'PB')
+BITRATE_UNITS = ('bps', 'Kbps', 'Mbps', 'Gbps', 'Tbps')
+
+def _scale_to_unit(value, base, units):
+    # Pick the unit directly from the magnitude instead of dividing in a loop
+    if value < 1:
+        return f"{value:.2f} {units[0]}"
+    i = min(int(math.log(value, base)), len(units) - 1)
+    return f"{value / base ** i:.2f} {units[i]}"
 
 def human_readable_size(size_in_bytes):
-    for unit in ['B', 'KB', 'MB', 'GB', 'TB']:
-        if size_in_bytes < 1024.0:
-            return f"{size_in_bytes:.2f} {unit}"
-        size_in_bytes /= 1024.0
-    return f"{size_in_bytes:.2f} PB"
+    return _scale_to_unit(size_in_bytes, 1024, SIZE_UNITS)
 
 def human_readable_bitrate(bitrate):
     if bitrate is None or bitrate == 'N/A':
         return 'N/A'
-    bitrate = float(bitrate)
-    for unit in ['bps', 'Kbps', 'Mbps', 'Gbps']:
-        if bitrate < 1000.0:
-            return f"{bitrate:.2f} {unit}"
-        bitrate /= 1000.0
-    return f"{bitrate:.2f} Tbps"
-
-def print_video_comparison(input_file, output_file):
-    input_info = get_video_info(input_file)
-    output_info = get_video_info(output_file)
+    return _scale_to_unit(float(bitrate), 1000, BITRATE_UNITS)
+
+def _streams_by_type(info):
+    # First stream of each codec type, found in a single pass
+    streams = {}
+    for stream in info['streams']:
+        streams.setdefault(stream['codec_type'], stream)
+    return streams
 
-    input_video_stream = next(s for s in input_info['streams'] if s['codec_type'] == 'video')
-    output_video_stream = next(s for s in output_info['streams'] if s['codec_type'] == 'video')
+def print_video_comparison(input_file, output_file, input_info=None, output_info=None):
+    if input_info is None:
+        input_info = get_video_info(input_file)
+    if output_info is None:
+        output_info = get_video_info(output_file)
 
-    input_audio_stream = next(s for s in input_info['streams'] if s['codec_type'] == 'audio')
-    output_audio_stream = next(s for s in output_info['streams'] if s['codec_type'] == 'audio')
+    input_streams = _streams_by_type(input_info)
+    output_streams = _streams_by_type(output_info)
+
+    input_video_stream = input_streams['video']
+    output_video_stream = output_streams['video']
+
+    input_audio_stream = input_streams['audio']
+    output_audio_stream = output_streams['audio']
 
     input_bitrate = input_info['format'].get('bit_rate', 'N/A')
     output_bitrate = output_info['format'].get('bit_rate', 'N/A')
 
-    logger.info("\nVideo Comparison:")
-    logger.info(f"{'Property':<20} {'Input':<30} {'Output':<30}")
-    logger.info("-" * 80)
-    logger.info(f"{'Video Codec':<20} {input_video_stream['codec_name']:<30} {output_video_stream['codec_name']:<30}")
-    logger.info(f"{'Audio Codec':<20} {input_audio_stream['codec_name']:<30} {output_audio_stream['codec_name']:<30}")
     input_res = f"{input_video_stream['width']}x{input_video_stream['height']}"
     output_res = f"{output_video_stream['width']}x{output_video_stream['height']}"
-    logger.info(f"{'Resolution':<20} {input_res:<30} {output_res:<30}")
-    logger.info(f"{'Bitrate':<20} {human_readable_bitrate(input_bitrate):<30} {human_readable_bitrate(output_bitrate):<30}")
-    logger.info(f"{'Duration':<20} {input_info['format']['duration']:<30} {output_info['format']['duration']:<30}")
-    logger.info(f"{'File Size':<20} {human_readable_size(os.path.getsize(input_file)):<30} {human_readable_size(os.path.getsize(output_file)):<30}")
 
-def verify_transcoding(input_file, output_file, tolerance=1.0):
-    logger.info("Verifying transcoding...")
+    # Emit the table as one record so concurrent transcodes cannot interleave it
+    lines = [
+        f"\nVideo Comparison: {os.path.basename(input_file)}",
+        f"{'Property':<20} {'Input':<30} {'Output':<30}",
+        "-" * 80,
+        f"{'Video Codec':<20} {input_video_stream['codec_name']:<30} {output_video_stream['codec_name']:<30}",
+        f"{'Audio Codec':<20} {input_audio_stream['codec_name']:<30} {output_audio_stream['codec_name']:<30}",
+        f"{'Resolution':<20} {input_res:<30} {output_res:<30}",
+        f"{'Bitrate':<20} {human_readable_bitrate(input_bitrate):<30} {human_readable_bitrate(output_bitrate):<30}",
+        f"{'Duration':<20} {input_info['format']['duration']:<30} {output_info['format']['duration']:<30}",
+        f"{'File Size':<20} {human_readable_size(os.path.getsize(input_file)):<30} {human_readable_size(os.path.getsize(output_file)):<30}",
+    ]
+    logger.info("\n".join(lines))
+
+def verify_transcoding(input_file, output_file, tolerance=1.0, input_info=None):
+    name = os.path.basename(input_file)
+    logger.info(f"Verifying transcoding of {name}...")
     
     if not os.path.exists(output_file):
         logger.error(f"Error: Output file does not exist: {output_file}")
@@ -137,19 +231,24 @@ def verify_transcoding(input_file, output_file, tolerance=1.0):
         logger.error(f"Error: Output file is empty: {output_file}")
         return False
     
-    input_info = get_video_info(input_file)
-    output_info = get_video_info(output_file)
+    if input_info is None:
+        input_info = get_video_info(input_file)
     
     input_duration = float(input_info['format']['duration'])
-    output_duration = float(output_info['format']['duration'])
+    # The full probe is cached, so print_video_comparison reuses it for the table
+    try:
+        output_duration = float(get_video_info(output_file)['format']['duration'])
+    except (ValueError, KeyError) as e:
+        logger.error(f"Error: Could not probe output file {output_file}: {e!r}")
+        return False
     
     duration_diff = abs(input_duration - output_duration)
     
     if duration_diff > tolerance:
-        logger.error(f"Error: Duration mismatch. Input: {input_duration:.2f}s, Output: {output_duration:.2f}s")
+        logger.error(f"Error: Duration mismatch for {name}. Input: {input_duration:.2f}s, Output: {output_duration:.2f}s")
         return False
     
-    logger.info("Verification passed: Output file exists, is non-empty, and has correct duration.")
+    logger.info(f"Verification passed for {name}: Output file exists, is non-empty, and has correct duration.")
     return True
 
 def detect_gpu():
@@ -204,25 +303,59 @@ def get_encoder(config_encoder, gpu_type):
         return gpu_encoders[gpu_type][config_encoder]
     return config_encoder
 
-def handle_handbrake_output(process, current_file, total_files, input_file):
-    progress_pattern = re.compile(r'Encoding: task \d+ of \d+, (\d+\.\d+) %.*?(\d+\.\d+) fps, avg (\d+\.\d+) fps, ETA (\d+h\d+m\d+s)')
+def is_already_target(input_info, encoder):
+    # Every supported encoder produces either H.264 or H.265, named as ffprobe reports them
+    target_codec = "hevc" if encoder.endswith("265") else "h264"
+    video_stream = _streams_by_type(input_info).get('video')
+    return video_stream is not None and video_stream['codec_name'] == target_codec
+
+def handle_handbrake_output(process, current_file, total_files, input_file, inline_progress=True):
+    # A single encode rewrites one status line; concurrent encodes would overwrite
+    # each other there, so they print one line per update instead
+    interval = PROGRESS_INTERVAL if inline_progress else CONCURRENT_PROGRESS_INTERVAL
+    line_start, line_end = ("\r", "") if inline_progress else ("", "\n")
+
+    def write_progress(match):
+        progress, current_fps, eta = match.groups()
+        with stdout_lock:
+            sys.stdout.write(f"{line_start}[{current_file}/{total_files}] {os.path.basename(input_file)} - Progress: {progress}% | FPS: {current_fps} | ETA: {eta}{line_end}")
+            sys.stdout.flush()
+
+    last_update = 0.0
+    # Most recent progress match that has not been written yet
+    pending = None
+    debug_enabled = logger.isEnabledFor(logging.DEBUG)
     for line in process.stdout:
-        match = progress_pattern.search(line)
-        if match:
-            progress, current_fps, avg_fps, eta = match.groups()
-            sys.stdout.write(f"\r[{current_file}/{total_files}] {os.path.basename(input_file)} - Progress: {progress}% | FPS: {current_fps} | ETA: {eta}")
+        if not line.startswith("Encoding:"):
+            if debug_enabled:
+                logger.debug(line.rstrip())
+            continue
+
+        # Early lines have no fps/ETA yet and must not use up an update slot
+        match = PROGRESS_PATTERN.search(line)
+        if not match:
+            continue
+        pending = match
+
+        # HandBrake reports progress several times a second, more than a terminal needs
+        now = time.monotonic()
+        if now - last_update < interval:
+            continue
+        last_update = now
+        write_progress(pending)
+        pending = None
+
+    # Show the final state even if it arrived inside the throttle window
+    if pending is not None:
+        write_progress(pending)
+    if inline_progress:
+        with stdout_lock:
+            sys.stdout.write("\n")
             sys.stdout.flush()
-        logger.debug(line.strip())
-    sys.stdout.write("\n")
-    sys.stdout.flush()
 
-def transcode_video(input_file, output_file, config, current_file, total_files):
+def transcode_video(input_file, output_file, config, current_file, total_files, gpu_type, inline_progress=True):
     logger.debug(f"Starting transcoding of {input_file}")
-    if not check_handbrake_installed():
-        logger.error("HandBrakeCLI is not installed. Please install it and try again.")
-        sys.exit(1)
 
-    gpu_type = detect_gpu()
     encoder = get_encoder(config['video_codec'], gpu_type)
     logger.debug(f"Detected GPU type: {gpu_type}")
     logger.debug(f"Using encoder: {encoder}")
@@ -233,6 +366,12 @@ def transcode_video(input_file, output_file, config, current_file, total_files):
         logger.error(f"Unsupported encoder: {encoder}. Falling back to x264.")
         encoder = "x264"
 
+    input_info = get_video_info(input_file)
+    if is_already_target(input_info, encoder) and not config.get('force_reencode', False):
+        shutil.copy2(input_file, output_file)
+        logger.info(f"Already encoded with the target codec, copied: {os.path.basename(input_file)}")
+        return
+
     command = [
         "HandBrakeCLI",
         "-i", input_file,
@@ -264,28 +403,49 @@ def transcode_video(input_file, output_file, config, current_file, total_files):
         ])
 
     try:
-        logger.debug(f"Running command: {' '.join(command)}")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Running command: %s", shlex.join(command))
         process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
-        handle_handbrake_output(process, current_file, total_files, input_file)
+        handle_handbrake_output(process, current_file, total_files, input_file, inline_progress)
         process.wait()
         if process.returncode != 0:
             raise subprocess.CalledProcessError(process.returncode, command)
         logger.info(f"Transcoding complete: {os.path.basename(input_file)}")
         
-        if verify_transcoding(input_file, output_file):
-            print_video_comparison(input_file, output_file)
+        if verify_transcoding(input_file, output_file, input_info=input_info):
+            print_video_comparison(input_file, output_file, input_info, get_video_info(output_file))
         else:
-            logger.error("Transcoding verification failed. Please check the output file.")
+            logger.error(f"Transcoding verification failed for {os.path.basename(input_file)}. Please check the output file.")
     except subprocess.CalledProcessError as e:
         logger.error(f"Error during transcoding: {e}")
-        sys.exit(1)
+        raise
+
+def get_max_concurrent(config, gpu_type):
+    if gpu_type == "cpu":
+        default = max(1, (os.cpu_count() or 1) // CPU_THREADS_PER_ENCODE)
+    else:
+        default = DEFAULT_GPU_CONCURRENCY
+
+    max_concurrent = config.get('max_concurrent', default)
+    if isinstance(max_concurrent, bool) or not isinstance(max_concurrent, int):
+        logger.error(f"Invalid max_concurrent in config: {max_concurrent!r}. Using {default}.")
+        max_concurrent = default
+    elif max_concurrent < 1:
+        logger.error(f"max_concurrent must be at least 1, got {max_concurrent}. Using 1.")
+        max_concurrent = 1
 
-def process_directory(config):
+    if gpu_type == "nvidia":
+        max_concurrent = min(max_concurrent, NVENC_SESSION_LIMIT)
+    return max_concurrent
+
+def process_directory(config, gpu_type):
     logger.debug("Processing directory")
     
     input_dir = os.path.expanduser(config['input_directory'])
     output_dir = os.path.expanduser(config['output_directory'])
     extensions = config['file_extensions']
+    # str.endswith accepts a tuple, so matching is a single call per file
+    ext_tuple = tuple(e.lower() if e.startswith('.') else '.' + e.lower() for e in extensions)
 
     logger.debug(f"Input directory: {input_dir}")
     logger.debug(f"Output directory: {output_dir}")
@@ -297,32 +457,69 @@ def process_directory(config):
             os.makedirs(dir_path)
             logger.info(f"Created directory: {dir_path}")
 
-    # Get total number of files to process
-    total_files = sum(len(files) for _, _, files in os.walk(input_dir) 
-                      if any(f.lower().endswith(ext) for f in files for ext in extensions))
-    
-    current_file = 0
-
-    # Walk through all subdirectories
+    # Collect matching files in a single pass over the input tree
+    tasks = []
     for root, dirs, files in os.walk(input_dir):
-        for file in files:
-            if any(file.lower().endswith(ext) for ext in extensions):
-                current_file += 1
-                input_file = os.path.join(root, file)
-                
-                # Create relative path
-                rel_path = os.path.relpath(root, input_dir)
-                
-                # Create corresponding output directory
-                output_subdir = os.path.join(output_dir, rel_path)
-                if not os.path.exists(output_subdir):
-                    os.makedirs(output_subdir)
-                
-                # Create output file path with the same name as input
-                output_file = os.path.join(output_subdir, file)
-                
-                # Call transcode function
-                transcode_video(input_file, output_file, config, current_file, total_files)
+        matches = [file for file in files if file.lower().endswith(ext_tuple)]
+        if not matches:
+            continue
+
+        # Create the corresponding output directory once per input directory
+        output_subdir = os.path.join(output_dir, os.path.relpath(root, input_dir))
+        os.makedirs(output_subdir, exist_ok=True)
+
+        # Output files keep the same name as their input
+        for file in matches:
+            tasks.append((os.path.join(root, file), os.path.join(output_subdir, file)))
+    total_files = len(tasks)
+
+    # Probe all inputs concurrently up front so later lookups hit the cache
+    logger.debug(f"Probing {total_files} input files")
+    prefetch_video_info([input_file for input_file, _ in tasks])
+
+    max_concurrent = get_max_concurrent(config, gpu_type)
+    logger.debug(f"Running up to {max_concurrent} transcodes concurrently")
+
+    # Set by the first failing worker so the others stop picking up new files
+    stop_event = threading.Event()
+
+    def run_task(numbered_task):
+        if stop_event.is_set():
+            return
+        current_file, (input_file, output_file) = numbered_task
+        try:
+            transcode_video(input_file, output_file, config, current_file, total_files, gpu_type, max_concurrent == 1)
+        except BaseException:
+            stop_event.set()
+            raise
+
+    # HandBrakeCLI does the actual work, so threads are enough to keep it busy.
+    # Each file gets its own HandBrakeCLI process, which keeps per-file progress,
+    # copy skipping and verification; running several at once hides the startup cost.
+    with ThreadPoolExecutor(max_workers=max_concurrent) as executor:
+        futures = []
+
+        def stop_pending(reason):
+            # Cancel files that were never started; encodes already running are
+            # left to finish before the error is raised
+            stop_event.set()
+            for future in futures:
+                future.cancel()
+            logger.error(f"{reason}; waiting for running transcodes to finish")
+
+        try:
+            for numbered_task in enumerate(tasks, start=1):
+                futures.append(executor.submit(run_task, numbered_task))
+            done, pending = wait(futures, return_when=FIRST_EXCEPTION)
+        except BaseException:
+            # e.g. KeyboardInterrupt delivered to the main thread while it waits
+            stop_pending("Interrupted")
+            raise
+
+        failed = next((future for future in done if future.exception() is not None), None)
+        if failed is not None:
+            stop_pending("Stopping after a failed transcode")
+            raise failed.exception()
 
     logger.info("Finished processing all directories and files")
 
@@ -336,10 +533,16 @@ if __name__ == "__main__":
     else:
         logger.info("No compatible GPU detected, using CPU encoding")
 
+    if not check_handbrake_installed():
+        logger.error("HandBrakeCLI is not installed. Please install it and try again.")
+        sys.exit(1)
+
     try:
         config = load_config()
         logger.debug("Config loaded successfully")
-        process_directory(config)
+        # Above DEBUG, HandBrake output lines and commands are not formatted at all
+        logger.setLevel(config['log_level'])
+        process_directory(config, gpu_type)
     except Exception as e:
         logger.exception("An error occurred:")
         sys.exit(1)